@@ -43,6 +43,10 @@ print_para_num(model)
 model.load_state_dict(torch.load(opt.model_path))
 print('successfully loading pretrained model.')
 
+if opt.compile:
+    # compiled lazily on the first call; inductor fuses the elementwise ops around the convolutions
+    model = torch.compile(model, mode=opt.compile_mode, dynamic=None)
+
 print('---------------------------------------- step 4/4 : testing... ----------------------------------------------------')   
 def main():
     model.eval()
@@ -2,15 +2,75 @@
 # Copyright (c) 2022 megvii-model. All Rights Reserved.
 # ------------------------------------------------------------------------
 
+import collections
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def _sat_combine(s, k1, k2):
+    # box averages from a summed-area table: row difference, column difference, scale; the leading
+    # window of each difference is read from the table itself instead of differencing a zero border
+    rows = torch.cat((s[:, :, k1 - 1:k1], s[:, :, k1:] - s[:, :, :-k1]), dim=2)
+    out = torch.cat((rows[:, :, :, k2 - 1:k2], rows[:, :, :, k2:] - rows[:, :, :, :-k2]), dim=3)
+    return out / (k1 * k2)
+
+def _replicate_pad(out, h, w):
+    # centre `out` back on an (h, w) plane by replicating its borders
+    _h, _w = out.shape[2:]
+    pad2d = ((w - _w) // 2, (w - _w + 1) // 2, (h - _h) // 2, (h - _h + 1) // 2)
+    return torch.nn.functional.pad(out, pad2d, mode='replicate')
+
+def _box_pool(x, k1, k2, auto_pad=True, sat_threshold=32 * 32, scratch=None):
+    # stride-1 box average with a resolved (k1, k2) kernel, i.e. the exact (non fast_imp) AvgPool2d;
+    # `scratch` is an optional dict, shared between pools, that keeps summed-area table storage alive
+    n, c, h, w = x.shape
+    if k1 >= h and k2 >= w:
+        # kernel covers the whole input: a single reduction per (n, c), no layout change needed
+        return x.mean(dim=(-2, -1), keepdim=True)
+    k1, k2 = min(h, k1), min(w, k2)
+
+    # kernel spans a whole axis: average it away once, leaving a 1-D box filter along the other
+    if k1 == h:
+        x, k1 = x.mean(dim=-2, keepdim=True), 1
+    elif k2 == w:
+        x, k2 = x.mean(dim=-1, keepdim=True), 1
+
+    # NHWC lets the spatial cumsums/differences and the pooling kernels vectorize over channels
+    x = x.contiguous(memory_format=torch.channels_last)
+
+    if k1 * k2 < sat_threshold:
+        # same (h - k1 + 1, w - k2 + 1) output as the SAT path below
+        out = F.avg_pool2d(x, kernel_size=(k1, k2), stride=1)
+    else:
+        # accumulate in fp32: an h*w long running sum overflows / loses precision in fp16 and bf16
+        dtype = torch.float32 if x.dtype in (torch.float16, torch.bfloat16) else x.dtype
+        # out= does not support autograd, so the shared storage is only used outside of it
+        if scratch is None or (torch.is_grad_enabled() and x.requires_grad):
+            s = x.cumsum(dim=-1, dtype=dtype)
+        else:
+            # one table per (n, c, dtype, device): a new resolution replaces it instead of adding one
+            key = (n, x.size(1), dtype, x.device)
+            s = scratch.get(key)
+            if s is None or s.shape != x.shape:
+                s = scratch[key] = torch.empty_like(x, dtype=dtype)
+            torch.cumsum(x, dim=-1, dtype=dtype, out=s)
+        s.cumsum_(dim=-2)
+        out = _sat_combine(s, k1, k2).to(x.dtype)
+
+    if auto_pad:
+        out = _replicate_pad(out, h, w)
+
+    return out
+
 class AvgPool2d(nn.Module):
-    def __init__(self, kernel_size=None, base_size=None, auto_pad=True, fast_imp=False, train_size=None):
+    def __init__(self, kernel_size=None, base_size=None, auto_pad=True, fast_imp=False, train_size=None,
+                 sat_threshold=32 * 32):
         super().__init__()
         self.kernel_size = kernel_size
+        if isinstance(base_size, int):
+            base_size = (base_size, base_size)
         self.base_size = base_size
         self.auto_pad = auto_pad
 
@@ -21,57 +81,100 @@ class AvgPool2d(nn.Module):
         self.max_r2 = self.rs[0]
         self.train_size = train_size
 
+        # kernels with fewer taps than this use F.avg_pool2d instead of the summed-area table; direct
+        # pooling reads k1*k2 inputs per output while the SAT costs ~6 passes over the plane, so
+        # moderate windows (e.g. 24x24) go direct and large TLC windows stay on the SAT
+        self.sat_threshold = sat_threshold
+
+        # (h, w) -> fast_imp (k1, k2, r1, r2), or None when the exact `_box_pool` path applies
+        # (always without fast_imp, and whenever the kernel covers the whole input)
+        self._cache = {}
+
+        # (h, w, k1, k2) -> number of calls, see enable_stats()
+        self.stats = None
+
+        # summed-area table storage shared across pools, set by Local_Base.convert(); None allocates per call
+        self._scratch = None
+
     def extra_repr(self) -> str:
         return 'kernel_size={}, base_size={}, stride={}, fast_imp={}'.format(
             self.kernel_size, self.base_size, self.kernel_size, self.fast_imp
         )
 
-    def forward(self, x):
+    def _geometry(self, h, w):
+        key = (h, w)
+        if key in self._cache:
+            return self._cache[key]
+
         if self.kernel_size is None and self.base_size:
+            # resolved once from the warm-up resolution, then kept fixed for every input size
             train_size = self.train_size
-            if isinstance(self.base_size, int):
-                self.base_size = (self.base_size, self.base_size)
-            self.kernel_size = list(self.base_size)
-            self.kernel_size[0] = x.shape[2] * self.base_size[0] // train_size[-2]
-            self.kernel_size[1] = x.shape[3] * self.base_size[1] // train_size[-1]
+            self.kernel_size = [h * self.base_size[0] // train_size[-2], w * self.base_size[1] // train_size[-1]]
 
             # only used for fast implementation
-            self.max_r1 = max(1, self.rs[0] * x.shape[2] // train_size[-2])
-            self.max_r2 = max(1, self.rs[0] * x.shape[3] // train_size[-1])
-
-        if self.kernel_size[0] >= x.size(-2) and self.kernel_size[1] >= x.size(-1):
-            return F.adaptive_avg_pool2d(x, 1)
-
-        if self.fast_imp:  # Non-equivalent implementation but faster
-            h, w = x.shape[2:]
-            if self.kernel_size[0] >= h and self.kernel_size[1] >= w:
-                out = F.adaptive_avg_pool2d(x, 1)
-            else:
-                r1 = [r for r in self.rs if h % r == 0][0]
-                r2 = [r for r in self.rs if w % r == 0][0]
-                # reduction_constraint
-                r1 = min(self.max_r1, r1)
-                r2 = min(self.max_r2, r2)
-                s = x[:, :, ::r1, ::r2].cumsum(dim=-1).cumsum(dim=-2)
-                n, c, h, w = s.shape
-                k1, k2 = min(h - 1, self.kernel_size[0] // r1), min(w - 1, self.kernel_size[1] // r2)
-                out = (s[:, :, :-k1, :-k2] - s[:, :, :-k1, k2:] - s[:, :, k1:, :-k2] + s[:, :, k1:, k2:]) / (k1 * k2)
-                out = torch.nn.functional.interpolate(out, scale_factor=(r1, r2))
+            self.max_r1 = max(1, self.rs[0] * h // train_size[-2])
+            self.max_r2 = max(1, self.rs[0] * w // train_size[-1])
+
+        if not self.fast_imp or (self.kernel_size[0] >= h and self.kernel_size[1] >= w):
+            geometry = None
         else:
-            n, c, h, w = x.shape
-            s = x.cumsum(dim=-1).cumsum_(dim=-2)
-            s = torch.nn.functional.pad(s, (1, 0, 1, 0))  # pad 0 for convenience
-            k1, k2 = min(h, self.kernel_size[0]), min(w, self.kernel_size[1])
-            s1, s2, s3, s4 = s[:, :, :-k1, :-k2], s[:, :, :-k1, k2:], s[:, :, k1:, :-k2], s[:, :, k1:, k2:]
-            out = s4 + s1 - s2 - s3
-            out = out / (k1 * k2)
+            r1 = [r for r in self.rs if h % r == 0][0]
+            r2 = [r for r in self.rs if w % r == 0][0]
+            # reduction_constraint
+            r1 = min(self.max_r1, r1)
+            r2 = min(self.max_r2, r2)
+            # x[:, :, ::r1, ::r2] keeps ceil(h / r1) x ceil(w / r2) samples, r1/r2 need not divide h/w
+            k1 = min(-(-h // r1) - 1, self.kernel_size[0] // r1)
+            k2 = min(-(-w // r2) - 1, self.kernel_size[1] // r2)
+            geometry = (k1, k2, r1, r2)
+
+        self._cache[key] = geometry
+        return geometry
+
+    def enable_stats(self):
+        # count calls per (h, w, k1, k2) to help tune `base_size`; also sees specialized forwards
+        if self.stats is None:
+            self.stats = collections.Counter()
+            self.register_forward_hook(AvgPool2d._record_stats)
+
+    @staticmethod
+    def _record_stats(module, inputs, output):
+        h, w = inputs[0].shape[2:]
+        module.stats[(h, w, min(h, module.kernel_size[0]), min(w, module.kernel_size[1]))] += 1
+
+    def release_scratch(self):
+        # free the cached summed-area tables, e.g. after tiled inference (for every pool sharing them)
+        if self._scratch is not None:
+            self._scratch.clear()
+
+    def specialize(self):
+        # bind the kernel resolved during warm-up, turning forward into one straight-line call
+        if self.fast_imp or self.kernel_size is None:
+            return
+        # the bound forward never consults the geometry cache again
+        self._cache.clear()
+        self.forward = self._forward_specialized
+
+    def _forward_specialized(self, x):
+        # auto_pad / sat_threshold / scratch are read per call, so they stay settable after convert()
+        return _box_pool(x, self.kernel_size[0], self.kernel_size[1], self.auto_pad, self.sat_threshold,
+                         self._scratch)
+
+    def forward(self, x):
+        geometry = self._geometry(x.size(-2), x.size(-1))
+        if geometry is None:
+            return _box_pool(x, self.kernel_size[0], self.kernel_size[1], self.auto_pad, self.sat_threshold,
+                             self._scratch)
+
+        k1, k2, r1, r2 = geometry
+        # Non-equivalent implementation but faster
+        x = x.contiguous(memory_format=torch.channels_last)
+        # windows start one sample in, as the unpadded SAT differences did
+        out = F.avg_pool2d(x[:, :, r1::r1, r2::r2], kernel_size=(k1, k2), stride=1)
+        out = torch.nn.functional.interpolate(out, scale_factor=(r1, r2), mode='nearest')
 
         if self.auto_pad:
-            n, c, h, w = x.shape
-            _h, _w = out.shape[2:]
-            # print(x.shape, self.kernel_size)
-            pad2d = ((w - _w) // 2, (w - _w + 1) // 2, (h - _h) // 2, (h - _h + 1) // 2)
-            out = torch.nn.functional.pad(out, pad2d, mode='replicate')
+            out = _replicate_pad(out, x.size(-2), x.size(-1))
 
         return out
 
@@ -82,7 +185,7 @@ def replace_layers(model, base_size, train_size, fast_imp, **kwargs):
             replace_layers(m, base_size, train_size, fast_imp, **kwargs)
 
         if isinstance(m, nn.AdaptiveAvgPool2d):
-            pool = AvgPool2d(base_size=base_size, fast_imp=fast_imp, train_size=train_size)
+            pool = AvgPool2d(base_size=base_size, fast_imp=fast_imp, train_size=train_size, **kwargs)
             assert m.output_size == 1
             setattr(model, n, pool)
 
@@ -102,3 +205,30 @@ class Local_Base():
         imgs = torch.rand(train_size)
         with torch.no_grad():
             self.forward(imgs)
+
+        # every pooling kernel is known now; all pools share one set of summed-area tables
+        scratch = {}
+        for m in self.modules():
+            if isinstance(m, AvgPool2d):
+                m._scratch = scratch
+                m.specialize()
+
+
+if __name__ == '__main__':
+    # fast_imp must match the original cumsum formulation, also when r1 does not divide h
+    def fast_imp_reference(x, kernel_size, r1, r2):
+        s = x[:, :, ::r1, ::r2].cumsum(dim=-1).cumsum(dim=-2)
+        n, c, h, w = s.shape
+        k1, k2 = min(h - 1, kernel_size[0] // r1), min(w - 1, kernel_size[1] // r2)
+        out = (s[:, :, :-k1, :-k2] - s[:, :, :-k1, k2:] - s[:, :, k1:, :-k2] + s[:, :, k1:, k2:]) / (k1 * k2)
+        return torch.nn.functional.interpolate(out, scale_factor=(r1, r2))
+
+    for h, w in [(120, 250), (125, 250)]:
+        pool = AvgPool2d(kernel_size=(192, 192), auto_pad=False, fast_imp=True)
+        pool.max_r1 = pool.max_r2 = 2
+        r1 = min(pool.max_r1, [r for r in pool.rs if h % r == 0][0])
+        r2 = min(pool.max_r2, [r for r in pool.rs if w % r == 0][0])
+        x = torch.rand(1, 2, h, w, dtype=torch.float64)
+        out, ref = pool(x), fast_imp_reference(x, pool.kernel_size, r1, r2)
+        assert out.shape == ref.shape and torch.allclose(out, ref), (h, w)
+    print('fast_imp matches the cumsum reference')
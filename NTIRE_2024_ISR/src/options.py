@@ -118,6 +118,14 @@ class TestOptions():
         # ---------------------------------------- step 4/4 : testing... -----------------------------------------------
         # self.parser.add_argument("--save_image", action='store_true', help="if specified, save image when testing")
         self.parser.add_argument("--save_image", default=True, help="if specified, save image when testing")
+        self.parser.add_argument("--compile", action='store_true',
+                                 help="if specified, torch.compile the model after loading the weights")
+        self.parser.add_argument("--compile_mode", type=str, default='default',
+                                 choices=['default', 'reduce-overhead', 'max-autotune'],
+                                 help="torch.compile mode used with --compile; 'max-autotune' benchmarks Triton "
+                                      "conv templates (e.g. fusing the depthwise c2_r + LReLU of RLFN) but re-tunes "
+                                      "for every new input size, and like 'reduce-overhead' it uses CUDA graphs, "
+                                      "so feed fixed-size tiles and .clone() outputs kept across calls")
 
     def parse(self, show=True):
         opt = self.parser.parse_args()